@@ -1,10 +1,18 @@
 import os
 import io
 import argparse
+import asyncio
+import base64
+import functools
+import math
+import re
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import zarr
 import numpy as np
-import dask.array as da
+import dask
+from numba import njit
 from PIL import Image
 from nicegui import ui
 from ome_zarr.io import parse_url
@@ -14,21 +22,155 @@ from ome_zarr.reader import Reader
 # Path to your .zarr root
 OME_PATH = "../Vedrana_master_project/3D_datasets/datasets/VoDaSuRe/Oak_A/output_ome.zarr"
 
+# Viewport edge in CSS pixels
+DISPLAY_SIZE = 400
+# Sharpening stops at the first level whose in-plane sides are all below
+# 2 * MAX_PLANE_SIZE (i.e. need no stride), so final frames are up to 1599 px
+MAX_PLANE_SIZE = 2 * DISPLAY_SIZE
+
+# Peak memory allowed while loading one pyramid level into RAM as uint8 (the
+# source-dtype compute plus the uint8 copy both count). The kept uint8 array is
+# at most 128 MiB (uint8 data) or ~85 MiB (uint16 data).
+PRELOAD_MAX_BYTES = 256 * 2**20
+# Groups whose resident level stays cached: worst case 2 x 128 MiB held in RAM
+RESIDENT_CACHE_SIZE = 2
+
+# 16-bit -> 8-bit lookup table (one gather pass instead of shift + cast)
+U16_TO_U8 = (np.arange(65536, dtype=np.uint32) >> 8).astype(np.uint8)
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="OME-Zarr Progressive Ortho-Viewer")
     parser.add_argument('--ome_path', type=str, default=OME_PATH, help='Path to the OME-Zarr root directory')
     args = parser.parse_args()
     return args
 
+# Planes are read as-is; never let dask rechunk while slicing
+dask.config.set({'array.slicing.split_large_chunks': False})
+
+# Serial on purpose: the kernel is called from several encode threads at once,
+# which numba's default (workqueue) parallel layer does not allow.
+@njit(cache=True)
+def u16_to_u8(src, dst):
+    """Fused shift + cast of a 2D uint16 slice into a preallocated uint8 buffer."""
+    for i in range(src.shape[0]):
+        for j in range(src.shape[1]):
+            dst[i, j] = np.uint8(src[i, j] >> 8)
+
+def to_uint8(arr):
+    """Converts a computed slice or volume to uint8 for display, dispatching on dtype."""
+    if arr.dtype == np.uint8:
+        return arr
+    if arr.dtype == np.uint16:
+        return U16_TO_U8.take(arr)
+    if arr.dtype.kind == 'f':
+        return np.clip(arr, 0, 255, out=arr).astype(np.uint8, copy=False)
+    # Other unsigned integers: keep the most significant byte
+    if arr.dtype.kind == 'u':
+        return (arr >> (8 * (arr.dtype.itemsize - 1))).astype(np.uint8, copy=False)
+    # Signed integers: negatives map to black, keep the top 8 of the magnitude bits
+    if arr.dtype.kind == 'i':
+        arr = np.maximum(arr, 0)
+        shift = 8 * arr.dtype.itemsize - 9
+        if shift < 0:
+            return arr.astype(np.uint8) << 1
+        return (arr >> shift).astype(np.uint8, copy=False)
+    raise TypeError(f"Unsupported dtype for display: {arr.dtype}")
+
+def make_plane_reader(data, head, tail):
+    """Returns a reader for one plane layout: only the plane number is filled in per call."""
+    return lambda i: data[head + (i,) + tail]
+
+def natural_key(name):
+    """Sort key that orders embedded numbers numerically ("2" before "10")."""
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+def open_consolidated_group(full_path):
+    """Opens a group from consolidated metadata, consolidating it first when the store allows."""
+    try:
+        return zarr.open_consolidated(full_path, mode='r')
+    except Exception:
+        pass
+    try:
+        zarr.consolidate_metadata(full_path)
+        return zarr.open_consolidated(full_path, mode='r')
+    except Exception:
+        # Read-only or unsupported store: fall back to per-array metadata
+        pass
+    try:
+        return zarr.open_group(full_path, mode='r')
+    except Exception:
+        return None
+
+def open_zarr_levels(group, shapes):
+    """Opens the raw zarr array behind every pyramid level, checked against the dask shapes."""
+    try:
+        attrs = group.attrs.asdict()
+        multiscales = attrs.get('multiscales') or attrs['ome']['multiscales']
+        levels = [group[d['path']] for d in multiscales[0]['datasets']]
+    except Exception:
+        return None
+
+    if len(levels) != len(shapes):
+        return None
+    if any(tuple(z.shape[-3:]) != s for z, s in zip(levels, shapes)):
+        return None
+    return tuple(levels)
+
+@functools.lru_cache(maxsize=16)
+def load_pyramid(full_path):
+    """Reads the multi-scale pyramid of one group; cached so revisiting a group is instant."""
+    # Consolidated metadata: one JSON read instead of one per array
+    group = open_consolidated_group(full_path)
+
+    loc = parse_url(full_path)
+    reader = Reader(loc)
+    nodes = list(reader())
+
+    # Extract dask arrays for all levels (reshape drops singleton axes as one graph layer)
+    pyramid = [p.reshape(tuple(d for d in p.shape if d != 1)) for p in nodes[0].data]
+    pyramid = tuple(p[0] if p.ndim > 3 else p for p in pyramid)
+    shapes = tuple(p.shape for p in pyramid)
+
+    # Raw zarr handles per level for direct plane reads (None -> use dask)
+    return pyramid, shapes, open_zarr_levels(group, shapes)
+
+@functools.lru_cache(maxsize=RESIDENT_CACHE_SIZE)
+def load_resident(full_path):
+    """Holds one level of a group in RAM as uint8, so its planes become plain views."""
+    pyramid = load_pyramid(full_path)[0]
+    for level, p in enumerate(pyramid):
+        # Finer levels are never displayed (see pick_fine_level), so never hold them
+        if any(d >= 2 * MAX_PLANE_SIZE for d in p.shape):
+            continue
+        if math.prod(p.shape) * (p.dtype.itemsize + 1) <= PRELOAD_MAX_BYTES:
+            return level, to_uint8(np.asarray(p.compute()))
+    return None, None
+
 class OMEZarrOrthoViewer:
     def __init__(self, zarr_root_path):
         self.root_path = zarr_root_path
 
         # 1. State & Configuration
-        self.HIGH_RES = 0
         self.DEBOUNCE_TIME = 0.2  # Wait 0.2s after sliding before sharpening
+        self.COARSE_BYTE_BUDGET = 16 * 2**20  # Max chunk bytes a plane may decode on the immediate pass
         self.last_interaction = time.time()
 
+        # Background prefetch of neighbouring slices while scrubbing
+        self.PREFETCH_RADIUS = 1
+        self.PREFETCH_MEMORY = 64  # Recently requested (axis, level, index) keys
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=2)
+        self._prefetch_futures = []
+        self._prefetched = OrderedDict()
+
+        # Image encoding runs off the UI thread. One single-worker pool per axis
+        # keeps that axis' jobs serialized, so its uint8 buffers can be reused.
+        self._encode_pools = [ThreadPoolExecutor(max_workers=1) for _ in range(3)]
+        self.encode_tasks = [None, None, None]
+
+        # Encoded frames by (axis, level, scaled_index, final), reused when bouncing between slices
+        self.FRAME_CACHE_SIZE = 64
+        self._frame_cache = OrderedDict()
+
         # UI references
         self.views = []
         self.sliders = []
@@ -69,7 +211,7 @@ class OMEZarrOrthoViewer:
                         ui.label(labels[i]).classes('font-bold text-slate-700 mb-2')
 
                         # Interactive Image View
-                        view = ui.interactive_image().style('width: 400px; height: 400px; background: black;')
+                        view = ui.interactive_image().style(f'width: {DISPLAY_SIZE}px; height: {DISPLAY_SIZE}px; background: black;')
                         self.views.append(view)
 
                         # Slider
@@ -91,84 +233,274 @@ class OMEZarrOrthoViewer:
         """Scans the Zarr root for sub-groups representing different volumes."""
         try:
             root = zarr.open_group(path, mode='r')
-            keys = sorted([k for k in root.group_keys()])
+            keys = sorted(root.group_keys(), key=natural_key)
             return keys if keys else ["0"]
         except Exception:
             return ["0"]
 
     def load_active_group(self, group_name):
         """Loads the multi-scale pyramid and centers the indices."""
-        full_path = os.path.join(self.root_path, group_name)
-        loc = parse_url(full_path)
-        reader = Reader(loc)
-        nodes = list(reader())
+        self.cancel_prefetch()
+        for task in self.encode_tasks:
+            if task and not task.done():
+                task.cancel()
+        self._frame_cache.clear()
 
-        # Extract dask arrays for all levels
-        self.pyramid = [da.squeeze(p) for p in nodes[0].data]
-        self.pyramid = [p[0] if p.ndim > 3 else p for p in self.pyramid]
-        self.shapes = [p.shape for p in self.pyramid]
+        full_path = os.path.join(self.root_path, group_name)
+        self.pyramid, self.shapes, self.zarr_levels = load_pyramid(full_path)
+        self.resident_level, self._resident_u8 = load_resident(full_path)
 
         # Set dynamic lowest resolution level
         self.LOW_RES = len(self.pyramid) - 1
 
+        # Per-axis sharpening floor: finer levels only add detail the viewport cannot show
+        self.fine_levels = [self.pick_fine_level(axis) for axis in range(3)]
+
+        # Per-axis level for the immediate pass, based on the chunk layout
+        self.chunk_shapes = [p.chunksize for p in self.pyramid]
+        self.coarse_levels = [max(self.pick_coarse_level(axis), self.fine_levels[axis]) for axis in range(3)]
+
+        # One reusable uint8 output buffer per axis, sized for its largest displayed plane
+        self._out_bufs = []
+        for axis in range(3):
+            max_pixels = max(math.prod(self.plane_shape(axis, level))
+                             for level in range(self.fine_levels[axis], len(self.shapes)))
+            self._out_bufs.append(np.empty(max_pixels, dtype=np.uint8))
+
+        # Plane readers specialized per [axis][level], so the hot path does no branching
+        self._readers = [[self.build_reader(axis, level) for level in range(len(self.shapes))]
+                         for axis in range(3)]
+
         # RESET TO MIDDLE of Level 0
         self.indices = [s // 2 for s in self.shapes[0]]
+        self._pending_idx = list(self.indices)
 
         # Initialize rendering state
         self.last_rendered_indices = [-1, -1, -1]
         self.rendered_levels = [self.LOW_RES] * 3
+        self.rendered_final = [False, False, False]
+        self._last_key = [None, None, None]
         self.last_interaction = time.time()
 
+    def chunks_touched(self, axis, level):
+        """Number of chunks intersected by a single plane orthogonal to `axis`."""
+        shape, chunks = self.shapes[level], self.chunk_shapes[level]
+        return math.prod(math.ceil(shape[d] / chunks[d]) for d in range(3) if d != axis)
+
+    def bytes_touched(self, axis, level):
+        """Uncompressed chunk bytes decoded to read a single plane orthogonal to `axis`."""
+        chunk_bytes = math.prod(self.chunk_shapes[level]) * self.pyramid[level].dtype.itemsize
+        return self.chunks_touched(axis, level) * chunk_bytes
+
+    def pick_coarse_level(self, axis):
+        """Finest level whose plane stays within the byte budget (cheapest level if none does)."""
+        cost = [self.bytes_touched(axis, level) for level in range(len(self.pyramid))]
+        # The in-memory level needs no I/O at all
+        if self.resident_level is not None:
+            cost[self.resident_level] = 0
+        for level, n in enumerate(cost):
+            if n <= self.COARSE_BYTE_BUDGET:
+                return level
+        return min(range(len(cost)), key=cost.__getitem__)
+
+    def pick_fine_level(self, axis):
+        """Finest level whose plane fits MAX_PLANE_SIZE without striding (coarsest if none does)."""
+        for level in range(len(self.shapes)):
+            if all(self.shapes[level][d] < 2 * MAX_PLANE_SIZE for d in range(3) if d != axis):
+                return level
+        return self.LOW_RES
+
+    def plane_index(self, axis, level, scaled_index):
+        """Index for one plane. Only levels too large for MAX_PLANE_SIZE are strided, which
+        for displayed planes means only when no pyramid level fits."""
+        shape = self.shapes[level]
+        index = [slice(None, None, max(1, shape[d] // MAX_PLANE_SIZE)) for d in range(3)]
+        index[axis] = scaled_index
+        return tuple(index)
+
+    def plane_shape(self, axis, level):
+        """Shape of the (strided) plane returned by read_plane."""
+        shape = self.shapes[level]
+        index = self.plane_index(axis, level, 0)
+        return tuple(len(range(*index[d].indices(shape[d]))) for d in range(3) if d != axis)
+
+    def out_buffer(self, axis, level):
+        """Contiguous (H, W) view into the axis' reusable uint8 buffer for this level."""
+        h, w = self.plane_shape(axis, level)
+        return self._out_bufs[axis][:h * w].reshape(h, w)
+
+    def build_reader(self, axis, level):
+        """Creates the plane reader for one (axis, level), bypassing dask when possible."""
+        index = self.plane_index(axis, level, 0)
+        head, tail = index[:axis], index[axis + 1:]
+
+        if level == self.resident_level:
+            return make_plane_reader(self._resident_u8, head, tail)
+
+        if self.zarr_levels is None:
+            # Lazy dask slice, computed in read_planes
+            return make_plane_reader(self.pyramid[level], head, tail)
+
+        # Drop leading (t, c) axes the same way the dask pyramid does
+        data = self.zarr_levels[level]
+        return make_plane_reader(data, (0,) * (data.ndim - 3) + head, tail)
+
+    def read_planes(self, keys):
+        """Reads (axis, level, scaled_index, ...) planes as numpy arrays, with one shared dask.compute on the fallback path."""
+        planes = [self._readers[axis][level](scaled_index) for axis, level, scaled_index, *_ in keys]
+        if self.zarr_levels is None:
+            planes = dask.compute(*planes, scheduler='threads')
+        return planes
+
+    def read_plane(self, axis, level, scaled_index):
+        """Reads one orthogonal plane as a numpy array."""
+        return self.read_planes([(axis, level, scaled_index)])[0]
+
+    def scale_index(self, axis, level0_index, level):
+        """Maps a level-0 slice index onto the given pyramid level."""
+        scale_factor = self.shapes[level][axis] / self.shapes[0][axis]
+        scaled_index = int(level0_index * scale_factor)
+        return min(scaled_index, self.shapes[level][axis] - 1)
+
+    def prefetch_neighbours(self, axis, level0_index, level):
+        """Queues background reads of the slices around the current one."""
+        # The in-memory level has nothing to warm up
+        if level == self.resident_level:
+            return
+
+        self._prefetch_futures = [f for f in self._prefetch_futures if not f.done()]
+
+        center = self.scale_index(axis, level0_index, level)
+        for offset in range(1, self.PREFETCH_RADIUS + 1):
+            for scaled_index in (center + offset, center - offset):
+                if not 0 <= scaled_index < self.shapes[level][axis]:
+                    continue
+                key = (axis, level, scaled_index)
+                if key in self._prefetched:
+                    self._prefetched.move_to_end(key)
+                    continue
+                self._prefetched[key] = None
+                if len(self._prefetched) > self.PREFETCH_MEMORY:
+                    self._prefetched.popitem(last=False)
+                self._prefetch_futures.append(
+                    self._prefetch_pool.submit(self.read_plane, axis, level, scaled_index))
+
+    def cancel_prefetch(self):
+        """Drops queued prefetches, e.g. when the active group changes."""
+        for future in self._prefetch_futures:
+            future.cancel()
+        self._prefetch_futures = []
+        self._prefetched.clear()
+
     def on_slider_move(self, axis, val):
-        """Handle user input: update index and interaction timestamp."""
-        self.indices[axis] = int(val)
+        """Handle user input: record the latest index; update_loop picks it up once per tick."""
+        self._pending_idx[axis] = int(val)
         self.last_interaction = time.time()
         # Update text immediately for responsiveness
-        self.slice_labels[axis].set_text(f"Slice: {self.indices[axis]:03d} / {self.shapes[0][axis]}")
+        self.slice_labels[axis].set_text(f"Slice: {self._pending_idx[axis]:03d} / {self.shapes[0][axis]}")
+
+    def accept_pending(self, is_moving):
+        """Coalesces slider events: applies pending indices, skipping sub-pixel steps while dragging."""
+        for i in range(3):
+            new, old = self._pending_idx[i], self.indices[i]
+            if new == old:
+                continue
+            # Steps smaller than one display pixel cannot change the view
+            if is_moving and abs(new - old) < max(1, self.shapes[0][i] // DISPLAY_SIZE):
+                continue
+            self.indices[i] = new
+            # Warm the chunk/OS cache for the next steps of the drag
+            self.prefetch_neighbours(i, new, self.coarse_levels[i])
 
     def update_loop(self):
         """Core logic for progressive sharpening through resolution levels."""
         now = time.time()
         is_moving = (now - self.last_interaction) < self.DEBOUNCE_TIME
+        self.accept_pending(is_moving)
 
+        pending = []
         for i in range(3):
-            # Step 1: User is sliding -> Show coarsest level immediately
+            # Step 1: User is sliding -> Show the cheapest level for this plane immediately
             if self.indices[i] != self.last_rendered_indices[i]:
-                self.render_slice(i, self.indices[i], self.LOW_RES)
+                coarse = self.coarse_levels[i]
+                final = not is_moving and coarse == self.fine_levels[i]
+                pending.append(self.plan_slice(i, self.indices[i], coarse, final))
                 self.last_rendered_indices[i] = self.indices[i]
-                self.rendered_levels[i] = self.LOW_RES
-
-            # Step 2: User stopped -> Sharpen progressively level by level
-            elif not is_moving and self.rendered_levels[i] > self.HIGH_RES:
-                next_level = self.rendered_levels[i] - 1
-                self.render_slice(i, self.indices[i], next_level)
+                self.rendered_levels[i] = coarse
+                self.rendered_final[i] = final
+
+            # Step 2: User stopped -> Sharpen progressively level by level, then
+            # settle on a lossless frame of the finest displayed level
+            elif not is_moving and not self.rendered_final[i]:
+                next_level = max(self.rendered_levels[i] - 1, self.fine_levels[i])
+                final = next_level == self.fine_levels[i]
+                pending.append(self.plan_slice(i, self.indices[i], next_level, final))
                 self.rendered_levels[i] = next_level
+                self.rendered_final[i] = final
+
+        # Read all planes of this tick in one batch, then hand them to the encoders
+        pending = [key for key in pending if key is not None]
+        if pending:
+            for key, arr in zip(pending, self.read_planes(pending)):
+                self.encode_tasks[key[0]] = asyncio.create_task(self.show_encoded(key, arr))
 
-    def render_slice(self, axis, level0_index, level):
-        """High-speed slice extraction with bit-shifting and PIL handover."""
+    def plan_slice(self, axis, level0_index, level, final):
+        """Updates the view from cache where possible; returns the plane key still to be read, or None."""
         # 1. Coordinate Mapping
-        scale_factor = self.shapes[level][axis] / self.shapes[0][axis]
-        scaled_index = int(level0_index * scale_factor)
-        scaled_index = min(scaled_index, self.shapes[level][axis] - 1)
-
-        # 2. Extract Data (Dask)
-        data = self.pyramid[level]
-        if axis == 0:
-            arr = data[scaled_index, :, :]
-        elif axis == 1:
-            arr = data[:, scaled_index, :]
+        scaled_index = self.scale_index(axis, level0_index, level)
+
+        # Nothing new to show if this exact plane is already on screen. `final` (PNG
+        # vs. JPEG) is part of the key, so settling replaces the lossy drag frame.
+        key = (axis, level, scaled_index, final)
+        if key == self._last_key[axis]:
+            return None
+        self._last_key[axis] = key
+
+        # A newer render for the same axis supersedes any encode still in flight
+        task = self.encode_tasks[axis]
+        if task and not task.done():
+            task.cancel()
+
+        cached = self._frame_cache.get(key)
+        if cached is not None:
+            self._frame_cache.move_to_end(key)
+            self.views[axis].source = cached
+            return None
+
+        # 2. Data is read by update_loop, batched with the other axes
+        return key
+
+    async def show_encoded(self, key, arr):
+        """Encodes a slice in the worker pool, caches it and hands the data URL to the view."""
+        axis, level, _, final = key
+        out = self.out_buffer(axis, level)
+        loop = asyncio.get_running_loop()
+        source = await loop.run_in_executor(self._encode_pools[axis], self.encode_slice, arr, final, out)
+
+        self._frame_cache[key] = source
+        if len(self._frame_cache) > self.FRAME_CACHE_SIZE:
+            self._frame_cache.popitem(last=False)
+        self.views[axis].source = source
+
+    def encode_slice(self, arr, final, out):
+        """Converts a slice to 8-bit and encodes it (JPEG while coarse, PNG for the final level)."""
+        if arr.dtype == np.uint16:
+            # FAST CONVERSION: one fused read/write pass into the reused buffer,
+            # wrapped by PIL without another copy
+            u16_to_u8(arr, out)
+            h, w = out.shape
+            img = Image.frombuffer('L', (w, h), out, 'raw', 'L', 0, 1)
         else:
-            arr = data[:, :, scaled_index]
-
-        # 3. FAST CONVERSION
-        # We compute the dask array and immediately bit-shift to 8-bit.
-        # This is much faster than floating point division.
-        arr_8bit = (arr.compute() >> 8).astype(np.uint8)
+            img = Image.fromarray(to_uint8(arr))
 
-        # 4. Update the UI
-        # By passing the PIL image object directly, NiceGUI handles the
-        # internal byte conversion correctly without the pathlib error.
-        self.views[axis].source = Image.fromarray(arr_8bit)
+        buf = io.BytesIO()
+        if final:
+            img.save(buf, format='PNG')
+            mime = 'image/png'
+        else:
+            img.save(buf, format='JPEG', quality=85)
+            mime = 'image/jpeg'
+        return f"data:{mime};base64,{base64.b64encode(buf.getvalue()).decode('ascii')}"
 
     def handle_group_change(self, e):
         self.status_label.set_text("Loading...")
@@ -176,12 +508,10 @@ class OMEZarrOrthoViewer:
         # 1. Update backend data
         self.load_active_group(e.value)
 
-        # 2. Batch update UI to prevent "flicker"
-        with ui.column():  # Small trick to group updates
-            for i, slider in enumerate(self.sliders):
-                new_max = self.shapes[0][i] - 1
-                slider.props(f'max={new_max}')
-                slider.set_value(self.indices[i])  # set_value is slightly faster than .value =
+        # 2. Update sliders to the new volume
+        for i, slider in enumerate(self.sliders):
+            slider.props(f'max={self.shapes[0][i] - 1}')
+            slider.set_value(self.indices[i])
 
         self.update_label_text()
         self.force_refresh()
@@ -196,6 +526,8 @@ class OMEZarrOrthoViewer:
         """Invalidates cache to trigger a fresh render in the next timer cycle."""
         self.last_rendered_indices = [-1, -1, -1]
         self.rendered_levels = [self.LOW_RES] * 3
+        self.rendered_final = [False, False, False]
+        self._last_key = [None, None, None]
 
 
 # --- Execution ---
@@ -1,6 +1,7 @@
 import os
 import io
 import argparse
+import re
 import time
 import zarr
 import numpy as np
@@ -24,6 +25,10 @@ def parse_arguments():
     args = parser.parse_args()
     return args
 
+def natural_key(name):
+    """Sort key that orders embedded numbers numerically ("2" before "10")."""
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
 class OMEZarrOrthoViewer:
     def __init__(self, zarr_root_path):
         self.root_path = zarr_root_path
@@ -33,6 +38,9 @@ class OMEZarrOrthoViewer:
         self.DEBOUNCE_TIME = 0.2  # Wait 0.2s after sliding before sharpening
         self.last_interaction = time.time()
 
+        # 16-bit -> 8-bit lookup table (one gather pass instead of shift + cast)
+        self._u16_to_u8 = (np.arange(65536, dtype=np.uint32) >> 8).astype(np.uint8)
+
         # UI references
         self.views = []
         self.sliders = []
@@ -107,16 +115,34 @@ class OMEZarrOrthoViewer:
         else:
             arr = data[:, :, scaled_index]
 
-        # push conversion into dask graph
-        arr = (arr >> 8).astype(np.uint8)
-
-        return arr.compute()
+        # convert after compute with a single LUT gather
+        return self.to_uint8(arr.compute())
+
+    def to_uint8(self, arr):
+        """Converts a computed slice to uint8 for display, dispatching on dtype."""
+        if arr.dtype == np.uint8:
+            return arr
+        if arr.dtype == np.uint16:
+            return self._u16_to_u8.take(arr)
+        if arr.dtype.kind == 'f':
+            return np.clip(arr, 0, 255, out=arr).astype(np.uint8, copy=False)
+        # Other unsigned integers: keep the most significant byte
+        if arr.dtype.kind == 'u':
+            return (arr >> (8 * (arr.dtype.itemsize - 1))).astype(np.uint8, copy=False)
+        # Signed integers: negatives map to black, keep the top 8 of the magnitude bits
+        if arr.dtype.kind == 'i':
+            arr = np.maximum(arr, 0)
+            shift = 8 * arr.dtype.itemsize - 9
+            if shift < 0:
+                return arr.astype(np.uint8) << 1
+            return (arr >> shift).astype(np.uint8, copy=False)
+        raise TypeError(f"Unsupported dtype for display: {arr.dtype}")
 
     def find_image_groups(self, path):
         """Scans the Zarr root for sub-groups representing different volumes."""
         try:
             root = zarr.open_group(path, mode='r')
-            keys = sorted([k for k in root.group_keys()])
+            keys = sorted(root.group_keys(), key=natural_key)
             return keys if keys else ["0"]
         except Exception:
             return ["0"]